@@ -0,0 +1,158 @@
+'''
+Suggest indexes for DRel queries.
+
+The advisor walks a `Select`, collecting the columns used by join
+conditions, `where`, `group` and `order`, and compares them with the
+indexes the database reports through Django's introspection.
+
+Queries can be registered at the module level with `register` so the
+`drelindexes` management command can check them all.
+
+'''
+from collections import namedtuple
+
+from django.db import connections
+
+from drel.ast import (
+    BinaryExpression, CompoundSelect, DescendingExpression, DjangoM2MTable,
+    DjangoTable, Field, FunctionExpression, Join, LabeledProjection, SubQuery)
+
+
+Suggestion = namedtuple('Suggestion', ['table', 'columns', 'clause'])
+
+registry = []
+
+
+def register(select, name=None):
+    '''Register a query to be checked by the advisor. Returns `select`.'''
+    registry.append((name, select))
+    return select
+
+
+def advise(select, using='default'):
+    '''Return a list of indexes missing for the query.'''
+    con = connections[using]
+    cursor = con.cursor()
+    indexes = {}
+    suggestions = []
+
+    for clause, table, columns in _candidates(select):
+        if table not in indexes:
+            indexes[table] = _indexes(con, cursor, table)
+        if _covered(columns, indexes[table], clause == "order"):
+            continue
+        if (table, columns) in [(s.table, s.columns) for s in suggestions]:
+            continue
+        suggestions.append(Suggestion(table, columns, clause))
+
+    cursor.close()
+    return suggestions
+
+
+def _candidates(select):
+    '''
+    Yield (clause, table, columns) for every clause of a select and
+    any selects nested in it.
+
+    '''
+    if isinstance(select, CompoundSelect):
+        for s in select._selects:
+            for c in _candidates(s):
+                yield c
+        return
+
+    subqueries = []
+
+    def clause(name, exprs):
+        fields = []
+        for expr in exprs:
+            fields.extend(_fields(expr, subqueries))
+        for table, columns in _by_table(fields):
+            yield (name, table, columns)
+
+    for join in select._joins:
+        if isinstance(join, Join):
+            for c in clause("join", [join._on]):
+                yield c
+    if select._where:
+        for c in clause("where", [select._where]):
+            yield c
+    if select._group:
+        for c in clause("group", select._group):
+            yield c
+    if select._order:
+        for c in clause("order", select._order):
+            yield c
+
+    tables = [select._source] + [j._table for j in select._joins]
+    subqueries.extend(t for t in tables if isinstance(t, SubQuery))
+    for subquery in subqueries:
+        for c in _candidates(subquery._select):
+            yield c
+
+
+def _fields(expr, subqueries):
+    '''The fields referred to by an expression.'''
+    if isinstance(expr, Field):
+        return [expr]
+    if isinstance(expr, BinaryExpression):
+        return _fields(expr._a, subqueries) + _fields(expr._b, subqueries)
+    if isinstance(expr, FunctionExpression):
+        return [f for a in expr._args for f in _fields(a, subqueries)]
+    if isinstance(expr, (DescendingExpression, LabeledProjection)):
+        return _fields(expr._expr, subqueries)
+    if isinstance(expr, SubQuery):
+        subqueries.append(expr)
+    return []
+
+
+def _by_table(fields):
+    '''Group fields by database table, keeping column order.'''
+    tables = []
+    columns = {}
+    for f in fields:
+        table = _db_table(f._table)
+        if table is None:
+            continue
+        if table not in columns:
+            tables.append(table)
+            columns[table] = []
+        if f._column not in columns[table]:
+            columns[table].append(f._column)
+    return [(t, tuple(columns[t])) for t in tables]
+
+
+def _db_table(table):
+    if isinstance(table, DjangoTable):
+        return table._model._meta.db_table
+    if isinstance(table, DjangoM2MTable):
+        return table._m2m.m2m_db_table()
+    return None
+
+
+def _indexes(con, cursor, table):
+    '''The column lists of the indexes on a table.'''
+    introspection = con.introspection
+    if hasattr(introspection, 'get_constraints'):
+        constraints = introspection.get_constraints(cursor, table)
+        return [tuple(c['columns']) for c in constraints.values()
+                if c['index'] or c['unique'] or c['primary_key']]
+    # Older backends only report single columns, and some (SQLite)
+    # report every column, so only primary key and unique columns can
+    # be trusted. Other indexes are invisible here and will be
+    # suggested again.
+    return [(column,) for (column, info)
+            in introspection.get_indexes(cursor, table).items()
+            if info['primary_key'] or info['unique']]
+
+
+def _covered(columns, indexes, ordered):
+    '''Is `columns` a prefix of an existing index?'''
+    for index in indexes:
+        prefix = index[:len(columns)]
+        if ordered and prefix == columns:
+            return True
+        if not ordered and len(prefix) == len(columns) and \
+                set(prefix) == set(columns):
+            return True
+    return False
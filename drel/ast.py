@@ -23,6 +23,12 @@ for example.
 
 '''
 from collections import namedtuple
+import threading
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
 
 from django.db import connections
 
@@ -147,6 +153,133 @@ class TableMixin(object):
         return Select(self, offset=offset)
 
 
+class StatementMixin(object):
+    '''Execution of a statement on a connection or session.'''
+
+    def _execute(self, using='default', session=None):
+        if session is not None:
+            return session.execute(self)
+
+        con = connections[using]
+        compiler = Compiler(con)
+        sql = self._compile(compiler)
+
+        cursor = con.cursor()
+        cursor.execute(sql, compiler.values)
+        return cursor
+
+    def _sql(self, using='default'):
+        con = connections[using]
+        compiler = Compiler(con)
+        return (self._compile(compiler), tuple(compiler.values))
+
+
+class QueryMixin(StatementMixin):
+    '''
+    Reading the rows of a query. Queries provide `_project`, the list
+    of projected fields, and a `_decoders` cache.
+
+    '''
+    @property
+    def subquery(self):
+        return SubQuery(self)
+
+    def union(self, other):
+        return self._compound("UNION", other)
+
+    def union_all(self, other):
+        return self._compound("UNION ALL", other)
+
+    def intersect(self, other):
+        return self._compound("INTERSECT", other)
+
+    def except_(self, other):
+        return self._compound("EXCEPT", other)
+
+    def _compound(self, op, other):
+        keys = [f.row_key for f in self._project]
+        if keys != [f.row_key for f in other._project]:
+            raise InvalidQuery(
+                "Projections differ: %s, %s" % (self, other))
+        return CompoundSelect(op, [self, other])
+
+    def to_model(self, model, using='default'):
+        sql, values = self._sql(using)
+        return model.objects.raw(sql, values)
+
+    def all(self, using='default', session=None):
+        '''Execute select and return all rows.'''
+        con = session.connection if session else connections[using]
+        decode = self._decoder(con)
+        cursor = self._execute(using, session)
+        cons = namedtuple('Row', [f.row_key for f in self._project])
+        rows = cursor.fetchall()
+        if session is None:
+            cursor.close()
+        if decode:
+            rows = [decode(row, con) for row in rows]
+        for row in rows:
+            yield cons(*row)
+
+    def one(self, using='default', session=None):
+        '''Execute select and return a single row.'''
+        con = session.connection if session else connections[using]
+        decode = self._decoder(con)
+        cursor = self._execute(using, session)
+        cons = namedtuple('Row', [f.row_key for f in self._project])
+        row = cursor.fetchone()
+        if session is None:
+            cursor.close()
+        if decode:
+            row = decode(row, con)
+        return cons(*row)
+
+    def _decoder(self, con):
+        '''
+        Return a function `decode(row, connection)` applying the Django
+        field converters of the projected fields to a row, or None if
+        no column needs converting. The function is generated once per
+        database alias, calling the converters of each column inline.
+        Connections are per thread, so callers pass in their own.
+
+        '''
+        try:
+            return self._decoders[con.alias]
+        except KeyError:
+            pass
+
+        names = {'context': {}}
+        columns = []
+        convert = False
+        for (i, f) in enumerate(self._project):
+            column = "row[%d]" % i
+            for (j, (converter, expr)) in enumerate(_converters(f, con)):
+                names["c%d_%d" % (i, j)] = converter
+                names["e%d" % i] = expr
+                column = "c%d_%d(%s, e%d, connection, context)" % (
+                    i, j, column, i)
+                convert = True
+            columns.append(column)
+
+        decode = None
+        if convert:
+            exec("def decode(row, connection):\n    return (%s,)\n" %
+                 ", ".join(columns), names)
+            decode = names['decode']
+
+        self._decoders[con.alias] = decode
+        return decode
+
+    def materialize(self, session, indexes=()):
+        '''
+        Store the result of the select in a temporary table that is
+        dropped when `session` exits. `indexes` is a list of labels, or
+        tuples of labels for composite indexes.
+
+        '''
+        return session.materialize(self, indexes)
+
+
 class DescendingExpression(AST):
     '''
     A wrapper around an expression, used to make it descending in
@@ -188,7 +321,7 @@ class BinaryExpression(AST, ExpressionMixin):
     def _compile_expression(self, compiler):
         a = self._a._compile_expression(compiler)
         b = self._b._compile_expression(compiler)
-        return "%s %s %s" % (a, self._op, b)
+        return "(%s %s %s)" % (a, self._op, b)
 
 
 class Const(AST, ExpressionMixin):
@@ -238,10 +371,13 @@ class FunctionExpression(AST, ExpressionMixin):
 
 
 class Field(AST, ExpressionMixin):
-    def __init__(self, table, column, label=None):
+    def __init__(self, table, column, label=None, field=None):
         self._table = table
         self._column = column
         self.row_key = label or column
+        # The Django model field, if any, used to convert values
+        # read from the database.
+        self._field = field
 
     def _compile_expression(self, compiler):
         alias = compiler.refer(self._table)
@@ -254,6 +390,54 @@ class Field(AST, ExpressionMixin):
         return "%s AS %s" % (expr, label)
 
 
+def _same_field(a, b):
+    '''Do `a` and `b` refer to the same column of the same table?'''
+    return (isinstance(a, Field) and isinstance(b, Field) and
+            a._table is b._table and a._column == b._column)
+
+
+def _model_field(f):
+    '''
+    The Django model field whose values a projected field holds, if
+    any. Expressions other than fields (e.g. aggregates) have none.
+
+    '''
+    if isinstance(f, LabeledProjection):
+        f = f._expr
+    if isinstance(f, Field):
+        return f._field
+    return None
+
+
+def _same_conversion(a, b):
+    '''Are values of the model fields `a` and `b` converted alike?'''
+    if a is b:
+        return True
+    if a is None or b is None or type(a) is not type(b):
+        return False
+    if hasattr(a, 'deconstruct'):
+        # Same class and options (e.g. decimal places).
+        return a.deconstruct()[1:] == b.deconstruct()[1:]
+    return True
+
+
+def _converters(f, con):
+    '''
+    The (converter, expression) pairs the database backend and Django
+    field apply to values of a projected field, in order.
+
+    '''
+    field = _model_field(f)
+    if field is None or not hasattr(con.ops, 'get_db_converters'):
+        # Older Django backends convert values themselves.
+        return []
+
+    expr = field.get_col(field.model._meta.db_table)
+    converters = (con.ops.get_db_converters(expr) +
+                  field.get_db_converters(con))
+    return [(c, expr) for c in converters]
+
+
 class Join(AST):
     def __init__(self, table, on, kind="INNER"):
         self._table = table
@@ -275,7 +459,7 @@ class CrossJoin(AST):
         return "CROSS JOIN %s" % table
 
 
-class Select(AST, ExpressionMixin):
+class Select(AST, ExpressionMixin, QueryMixin):
     '''Representation of a SELECT SQL statement.'''
 
     def __init__(self, source, project=None, joins=None,
@@ -289,6 +473,7 @@ class Select(AST, ExpressionMixin):
         self._order = order
         self._limit = limit
         self._offset = offset
+        self._decoders = {}
 
     def project(self, *fields):
         return self._modified(_project=fields)
@@ -320,10 +505,6 @@ class Select(AST, ExpressionMixin):
     def offset(self, offset):
         return self._modified(_offset=offset)
 
-    @property
-    def subquery(self):
-        return SubQuery(self)
-
     def _clone(self):
         # Note: copy.copy interacts badly with __getattr__
         return Select(
@@ -347,36 +528,134 @@ class Select(AST, ExpressionMixin):
         joins.append(join)
         return self._modified(_joins=joins)
 
-    def _execute(self, using='default'):
-        con = connections[using]
-        compiler = Compiler(con)
-        sql = self._compile(compiler)
-
-        cursor = con.cursor()
-        cursor.execute(sql, compiler.values)
-        return cursor
-
-    def _sql(self, using='default'):
-        con = connections[using]
-        compiler = Compiler(con)
-        return (self._compile(compiler), tuple(compiler.values))
-
-    def to_model(self, model, using='default'):
-        sql, values = self._sql(using)
-        return model.objects.raw(sql, values)
-
-    def all(self, using='default'):
-        '''Execute select and return all rows.'''
-        cursor = self._execute(using)
-        cons = namedtuple('Row', [f.row_key for f in self._project])
-        for row in cursor.fetchall():
-            yield cons(*row)
-
-    def one(self, using='default'):
-        '''Execute select and return a single row.'''
-        cursor = self._execute(using)
-        cons = namedtuple('Row', [f.row_key for f in self._project])
-        return cons(*cursor.fetchone())
+    def partition(self, key, partitions, using='default'):
+        '''
+        Split the select into at most `partitions` selects over
+        disjoint ranges of the integer expression `key`.
+
+        '''
+        if self._limit is not None or self._offset is not None:
+            raise InvalidQuery("Cannot partition a limited select.")
+
+        if partitions < 1:
+            raise InvalidQuery("Need at least one partition.")
+
+        # A group split across partitions would be returned once per
+        # partition, unless every group has a single key value.
+        if self._group and not any(_same_field(g, key)
+                                   for g in self._group):
+            raise InvalidQuery(
+                "Cannot partition a grouped select except by a group key.")
+
+        bounds = self._modified(
+            _project=[FunctionExpression("MIN", key).label("lo"),
+                      FunctionExpression("MAX", key).label("hi")],
+            _group=None,
+            _order=None).one(using)
+
+        # Range predicates never match a NULL key (e.g. from the right
+        # side of a left join), so those rows get a partition of their
+        # own, last.
+        nulls = self.where(key.is_null)
+        if bounds.lo is None:
+            return [nulls]
+
+        step = -(-(bounds.hi - bounds.lo + 1) // partitions)
+        ranges = [self.where((key >= Const(lo)) & (key < Const(lo + step)))
+                  for lo in range(bounds.lo, bounds.hi + 1, step)]
+        return ranges + [nulls]
+
+    def partitioned(self, key, partitions, using='default', workers=4,
+                    ordered=False, batch_size=1000, buffer=4):
+        '''
+        Execute the select as range scans over `key` (see `partition`),
+        each run by a worker thread on its own connection. The
+        connection is closed after every partition so a scan never
+        holds on to one transaction.
+
+        Rows are yielded as they are fetched, or in `key` order (with
+        NULL keys last) if `ordered` is set. Workers fetch `batch_size`
+        rows at a time and stop when `buffer` batches are waiting, so
+        at most about (`workers` + 1) * `buffer` * `batch_size` rows
+        are held in memory (per running partition when `ordered`).
+
+        '''
+        selects = self.partition(key, partitions, using)
+        if ordered:
+            selects = [s.order(key) for s in selects]
+            queues = [Queue(maxsize=buffer) for _ in selects]
+        else:
+            queues = [Queue(maxsize=buffer)] * len(selects)
+
+        pending = Queue()
+        for i in range(len(selects)):
+            pending.put(i)
+        stop = threading.Event()
+
+        def put(queue, item):
+            # Give up if the consumer has gone away.
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def scan(select):
+            con = connections[using]
+            decode = select._decoder(con)
+            cons = namedtuple('Row', [f.row_key for f in select._project])
+            cursor = select._execute(using)
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    if decode:
+                        rows = [decode(row, con) for row in rows]
+                    yield [cons(*row) for row in rows]
+            finally:
+                cursor.close()
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    i = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    for rows in scan(selects[i]):
+                        if not put(queues[i], (rows, None)):
+                            return
+                    put(queues[i], (None, None))
+                except Exception as e:
+                    put(queues[i], (None, e))
+                finally:
+                    connections[using].close()
+
+        for _ in range(min(workers, len(selects))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+
+        try:
+            if ordered:
+                sources = [(q, 1) for q in queues]
+            else:
+                sources = [(queues[0], len(selects))]
+            for (queue, remaining) in sources:
+                while remaining:
+                    rows, error = queue.get()
+                    if error is not None:
+                        raise error
+                    if rows is None:
+                        remaining -= 1
+                        continue
+                    for row in rows:
+                        yield row
+        finally:
+            stop.set()
 
     def _compile(self, compiler):
         assert self._project, "No fields projected."
@@ -414,6 +693,253 @@ class Select(AST, ExpressionMixin):
         return " ".join(sql)
 
 
+class CompoundSelect(AST, ExpressionMixin, QueryMixin):
+    '''
+    Selects combined by a set operation (UNION, UNION ALL, INTERSECT or
+    EXCEPT). The combined rows can be ordered and limited, and are
+    labelled by the projection of the first select.
+
+    '''
+    def __init__(self, op, selects, order=None, limit=None, offset=None):
+        self._op = op
+        self._selects = selects
+        self._order = order
+        self._limit = limit
+        self._offset = offset
+        self._decoders = {}
+
+        # The first select's fields label the rows. A column keeps its
+        # model field (for decoding and for reading it through a
+        # subquery or materialized table) only if every select's values
+        # for it are converted alike; otherwise it is exposed as a bare
+        # label.
+        self._project = []
+        for (i, f) in enumerate(selects[0]._project):
+            field = _model_field(f)
+            if all(_same_conversion(field, _model_field(s._project[i]))
+                   for s in selects[1:]):
+                self._project.append(f)
+            else:
+                self._project.append(
+                    LabeledProjection(f.row_key, LabelReference(f.row_key)))
+
+    def order(self, *fields):
+        return self._modified(order=fields)
+
+    def limit(self, limit):
+        return self._modified(limit=limit)
+
+    def offset(self, offset):
+        return self._modified(offset=offset)
+
+    def _modified(self, **kwargs):
+        args = dict(order=self._order, limit=self._limit, offset=self._offset)
+        args.update(kwargs)
+        return CompoundSelect(self._op, self._selects, **args)
+
+    def _compound(self, op, other):
+        c = QueryMixin._compound(self, op, other)
+        if op == self._op and self._order is None and \
+                self._limit is None and self._offset is None:
+            # Extend rather than nest: a UNION b UNION c
+            return CompoundSelect(op, self._selects + [other])
+        return c
+
+    def _compile_member(self, select, compiler):
+        sql = select._compile(compiler)
+        if isinstance(select, CompoundSelect) or select._order or \
+                select._limit is not None or select._offset is not None:
+            # Ordered, limited and compound members have to be
+            # wrapped to be combined.
+            return "SELECT * FROM (%s) AS %s" % (sql, compiler.refer(select))
+        return sql
+
+    def _compile(self, compiler):
+        op = " %s " % self._op
+        sql = [op.join(self._compile_member(s, compiler)
+                       for s in self._selects)]
+
+        if self._order:
+            # The combined rows can only be ordered by their labels.
+            labels = [f.row_key for f in self._project]
+            order_sql = ",".join(
+                _compile_label(f, labels, compiler) for f in self._order)
+            sql.append("ORDER BY")
+            sql.append(order_sql)
+
+        if self._limit is not None:
+            sql.append("LIMIT %d" % self._limit)
+
+        if self._offset is not None:
+            sql.append("OFFSET %d" % self._offset)
+
+        return " ".join(sql)
+
+
+def _compile_label(expr, labels, compiler):
+    if isinstance(expr, DescendingExpression):
+        return "%s DESC" % _compile_label(expr._expr, labels, compiler)
+
+    if isinstance(expr, LabelReference):
+        label = expr._label
+    elif hasattr(expr, 'row_key'):
+        label = expr.row_key
+    else:
+        return expr._compile_expression(compiler)
+
+    if label not in labels:
+        raise InvalidQuery("%s is not projected" % label)
+    return compiler.q(label)
+
+
+class Upsert(AST, StatementMixin):
+    '''
+    Representation of an INSERT statement into a Django or named table
+    that updates the existing rows it conflicts with, using the
+    backend's native syntax.
+
+    `update` is a list of (column, expression) pairs.
+
+    '''
+    def __init__(self, table, columns, rows, conflict,
+                 update=None, returning=None):
+        self._table = table
+        self._columns = columns
+        self._rows = rows
+        self._conflict = conflict
+        self._update = update or []
+        self._returning = returning or []
+
+    def execute(self, using='default', session=None, batch_size=None):
+        '''
+        Execute the upsert in batches that fit the backend's parameter
+        limit (and `batch_size`, if given), returning the `returning`
+        fields of the affected rows.
+
+        Of rows with the same conflict key only the last is inserted,
+        as a statement may not update a row twice.
+
+        '''
+        con = session.connection if session else connections[using]
+        if con.vendor == 'sqlite':
+            version = _sqlite_version()
+            if version < (3, 24):
+                raise InvalidQuery("Upserts need SQLite 3.24 or later")
+            if self._returning and version < (3, 35):
+                raise InvalidQuery("RETURNING needs SQLite 3.35 or later")
+
+        limit = getattr(con.features, 'max_query_params', None)
+        if not limit:
+            limit = 999 if con.vendor == 'sqlite' else 65535
+
+        # The update expressions' values are sent with every batch.
+        compiler = Compiler(con)
+        for (_, e) in self._update:
+            e._compile_expression(compiler)
+        limit -= len(compiler.values)
+
+        size = max(1, limit // len(self._columns))
+        if batch_size:
+            size = min(size, batch_size)
+
+        rows = self._unique_rows()
+        cons = namedtuple('Row', [f.row_key for f in self._returning])
+        results = []
+        for i in range(0, len(rows), size):
+            batch = Upsert(self._table, self._columns, rows[i:i + size],
+                           self._conflict, self._update, self._returning)
+            if session is None:
+                cursor = batch._execute(using)
+            else:
+                # Batches are never reused, so don't let the session
+                # hold on to them.
+                cursor = session.execute(batch, cache=False)
+            if self._returning:
+                results.extend(cons(*row) for row in cursor.fetchall())
+            if session is None:
+                cursor.close()
+        return results
+
+    def _unique_rows(self):
+        if any(c not in self._columns for c in self._conflict):
+            return self._rows
+
+        indexes = [self._columns.index(c) for c in self._conflict]
+        seen = set()
+        rows = []
+        for row in reversed(self._rows):
+            key = tuple(row[i] for i in indexes)
+            if key not in seen:
+                seen.add(key)
+                rows.append(row)
+        rows.reverse()
+        return rows
+
+    def _compile(self, compiler):
+        assert self._rows, "No rows to insert."
+
+        # Refer to the table by name: MySQL can't alias an INSERT.
+        if isinstance(self._table, NamedTable):
+            name = self._table._name
+        else:
+            name = self._table._model._meta.db_table
+        table = compiler.name(self._table, compiler.q(name))
+        columns = ",".join(compiler.q(c) for c in self._columns)
+        row_sql = "(%s)" % ",".join(["%s"] * len(self._columns))
+        sql = ["INSERT INTO %s (%s) VALUES %s" % (
+            table, columns, ",".join([row_sql] * len(self._rows)))]
+        for row in self._rows:
+            compiler.values.extend(row)
+
+        update = ",".join(
+            "%s = %s" % (compiler.q(c), e._compile_expression(compiler))
+            for (c, e) in self._update)
+
+        if compiler.vendor == 'mysql':
+            if self._returning:
+                raise InvalidQuery("MySQL does not support RETURNING")
+            if not update:
+                # Updating a key to itself is the MySQL way of ignoring
+                # the conflict.
+                c = compiler.q(self._conflict[0])
+                update = "%s = %s" % (c, c)
+            sql.append("ON DUPLICATE KEY UPDATE %s" % update)
+        else:
+            conflict = ",".join(compiler.q(c) for c in self._conflict)
+            sql.append("ON CONFLICT (%s)" % conflict)
+            if update:
+                sql.append("DO UPDATE SET %s" % update)
+            else:
+                sql.append("DO NOTHING")
+
+        if self._returning:
+            sql.append("RETURNING %s" % ",".join(
+                compiler.q(f._column) for f in self._returning))
+
+        return " ".join(sql)
+
+
+def _sqlite_version():
+    from django.db.backends.sqlite3.base import Database
+    return Database.sqlite_version_info
+
+
+class Excluded(AST, ExpressionMixin):
+    '''
+    In an upsert, the value a field would have had in the row that
+    failed to insert.
+
+    '''
+    def __init__(self, field):
+        self._field = field
+
+    def _compile_expression(self, compiler):
+        column = compiler.q(self._field._column)
+        if compiler.vendor == 'mysql':
+            return "VALUES(%s)" % column
+        return "excluded.%s" % column
+
+
 class SubQuery(AST, ExpressionMixin, TableMixin):
     def __init__(self, select):
         self._select = select
@@ -428,7 +954,30 @@ class SubQuery(AST, ExpressionMixin, TableMixin):
     def __getattr__(self, key):
         for f in self._select._project:
             if key == f.row_key:
-                return Field(self, key)
+                return Field(self, key, field=_model_field(f))
+
+        raise AttributeError(key)
+
+
+class NamedTable(AST, TableMixin):
+    '''
+    A table referred to by name, such as a temporary table, with the
+    columns of a select's projection.
+
+    '''
+    def __init__(self, name, project):
+        self._name = name
+        self._columns = [f.row_key for f in project]
+        self._fields = dict((f.row_key, _model_field(f)) for f in project)
+
+    def _compile_table(self, compiler):
+        alias = compiler.refer(self)
+        table = compiler.q(self._name)
+        return "%s AS %s" % (table, alias)
+
+    def __getattr__(self, key):
+        if key in self._columns:
+            return Field(self, key, field=self._fields[key])
 
         raise AttributeError(key)
 
@@ -447,9 +996,9 @@ class DjangoTable(AST, TableMixin):
     def __getattr__(self, key):
         for f in self._model._meta.fields:
             if key == f.name:
-                return Field(self, f.column, f.name)
+                return Field(self, f.column, f.name, f)
             if key == f.column:
-                return Field(self, f.column)
+                return Field(self, f.column, field=f)
 
         raise AttributeError(key)
 
@@ -9,6 +9,11 @@ class Compiler(object):
         self.values = []
         self._connection = connection
 
+    @property
+    def vendor(self):
+        '''The database backend, e.g. 'sqlite' or 'postgresql'.'''
+        return self._connection.vendor
+
     def q(self, s):
         '''Quote a name.'''
         return self._connection.ops.quote_name(s)
@@ -25,3 +30,8 @@ class Compiler(object):
             alias = self.q("t%d" % len(self._aliases))
             self._aliases[obj] = alias
             return alias
+
+    def name(self, obj, name):
+        '''Refer to an object by the given name instead of an alias.'''
+        self._aliases[obj] = name
+        return name
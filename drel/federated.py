@@ -0,0 +1,129 @@
+'''
+Joins across databases.
+
+A `HashJoin` joins the results of two selects, each executed on its own
+Django database alias, in Python. Filters belong in the selects
+themselves so each database only returns the rows that take part in
+the join. One side is loaded into a hash table and the other side is
+streamed past it in batches, so memory is bounded by the build side.
+
+The build side can be given as `build`. Otherwise both selects are
+first counted to pick the smaller, which runs each of them an extra
+time -- pass `build` when either side is expensive to compute.
+
+'''
+from collections import namedtuple
+
+from django.db import connections
+
+from drel.ast import FunctionExpression, InvalidQuery, RawExpression
+
+
+class HashJoin(object):
+    def __init__(self, left, right, on, using, kind="INNER",
+                 build=None, batch_size=1000):
+        '''
+        `on` is a list of (left label, right label) pairs to join on,
+        `using` a (left alias, right alias) pair and `build` "left",
+        "right" or None to pick the smaller side.
+
+        '''
+        if kind not in ("INNER", "LEFT"):
+            raise InvalidQuery("Unsupported join: %s" % kind)
+        if build not in (None, "left", "right"):
+            raise InvalidQuery("Unsupported build side: %s" % build)
+
+        self._left = left
+        self._right = right
+        self._using = using
+        self._kind = kind
+        self._build = build
+        self._batch_size = batch_size
+
+        left_labels = [f.row_key for f in left._project]
+        right_labels = [f.row_key for f in right._project]
+        for label in right_labels:
+            if label in left_labels:
+                raise InvalidQuery("%s is projected by both sides" % label)
+
+        self._left_key = [_index(left_labels, l) for (l, _) in on]
+        self._right_key = [_index(right_labels, r) for (_, r) in on]
+        self._cons = namedtuple('Row', left_labels + right_labels)
+
+    def all(self):
+        '''Execute the join and return all rows.'''
+        build = self._build
+        if build is None:
+            left_using, right_using = self._using
+            if self._count(self._left, left_using) < \
+                    self._count(self._right, right_using):
+                build = "left"
+        if build == "left":
+            return self._build_left()
+        return self._build_right()
+
+    def _build_right(self):
+        table = self._hash(self._right, self._using[1], self._right_key)
+        missing = (None,) * len(self._right._project)
+        for row in self._stream(self._left, self._using[0]):
+            matches = table.get(_key(row, self._left_key), ())
+            for match in matches:
+                yield self._cons(*(row + match))
+            if not matches and self._kind == "LEFT":
+                yield self._cons(*(row + missing))
+
+    def _build_left(self):
+        table = self._hash(self._left, self._using[0], self._left_key)
+        matched = set()
+        for row in self._stream(self._right, self._using[1]):
+            key = _key(row, self._right_key)
+            for match in table.get(key, ()):
+                matched.add(key)
+                yield self._cons(*(match + row))
+
+        if self._kind == "LEFT":
+            missing = (None,) * len(self._right._project)
+            for (key, rows) in table.items():
+                if key not in matched:
+                    for row in rows:
+                        yield self._cons(*(row + missing))
+
+    def _hash(self, select, using, indexes):
+        table = {}
+        for row in self._stream(select, using):
+            table.setdefault(_key(row, indexes), []).append(row)
+        return table
+
+    def _stream(self, select, using):
+        con = connections[using]
+        decode = select._decoder(con)
+        cursor = select._execute(using)
+        try:
+            while True:
+                rows = cursor.fetchmany(self._batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield decode(row, con) if decode else tuple(row)
+        finally:
+            cursor.close()
+
+    def _count(self, select, using):
+        count = FunctionExpression("COUNT", RawExpression("*")).label("n")
+        return select.subquery.project(count).one(using).n
+
+
+def _index(labels, label):
+    if label not in labels:
+        raise InvalidQuery("%s is not projected" % label)
+    return labels.index(label)
+
+
+def _key(row, indexes):
+    # NULLs never compare equal, so rows with a NULL key can't match
+    # anything. They are kept (for left joins) under a key unique to
+    # the row.
+    key = tuple(row[i] for i in indexes)
+    if None in key:
+        return object()
+    return key
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from drel.advisor import advise, registry
+
+
+class Command(BaseCommand):
+    help = ("Suggest indexes for registered DRel queries. Modules given "
+            "as arguments are imported first so their queries register.")
+    args = '[module ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default='default',
+                    help='The database to check indexes against.'),
+        )
+
+    def handle(self, *modules, **options):
+        using = options.get('database', 'default')
+        q = connections[using].ops.quote_name
+
+        for module in modules:
+            __import__(module)
+
+        for (name, select) in registry:
+            for s in advise(select, using):
+                self.stdout.write("CREATE INDEX %s ON %s (%s); -- %s %s\n" % (
+                    q("%s_%s" % (s.table, "_".join(s.columns))),
+                    q(s.table),
+                    ",".join(q(c) for c in s.columns),
+                    name or select,
+                    s.clause))
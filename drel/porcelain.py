@@ -3,8 +3,14 @@ User facing top-level functions.
 
 '''
 from drel.ast import (
-    DjangoTable, DjangoM2MTable, Const,
-    FunctionExpression, LabelReference, RawExpression)
+    InvalidQuery, DjangoTable, DjangoM2MTable, Const, Excluded,
+    FunctionExpression, LabelReference, LabeledProjection, RawExpression,
+    Upsert)
+from drel.session import Session
+from drel.advisor import advise, register
+from drel.summary import SummaryTable
+from drel.federated import HashJoin
+from django.db import connections
 from django.db.models.base import ModelBase
 from django.db.models.fields.related import ReverseManyRelatedObjectsDescriptor
 
@@ -21,6 +27,82 @@ def table(t):
     return DjangoTable(t)
 
 
+def session(using='default', atomic=False):
+    '''
+    A context manager for running several statements on one cursor,
+    in a single transaction if `atomic`. Pass it to `.all()` or
+    `.one()` with the `session` keyword.
+
+    '''
+    return Session(using, atomic)
+
+
+def upsert(t, rows, conflict, update=(), returning=(),
+           using='default', session=None, batch_size=None):
+    '''
+    Insert `rows`, a list of dicts with the same field name keys, into
+    a Django table. Rows that conflict on the `conflict` fields update the
+    `update` fields instead: either field names, which take the value
+    that was to be inserted, or labelled expressions. Returns the
+    `returning` fields of the affected rows.
+
+    If several rows share a conflict key, only the last is used.
+
+    '''
+    if not rows:
+        return []
+
+    con = session.connection if session else connections[using]
+    keys = list(rows[0])
+    fields = [getattr(t, k) for k in keys]
+    columns = [f._column for f in fields]
+    # Prepare values for the database as Django's own inserts do.
+    prep = [f._field.get_db_prep_save for f in fields]
+    values = [tuple(p(row[k], con) for (p, k) in zip(prep, keys))
+              for row in rows]
+
+    updates = []
+    for u in update:
+        if isinstance(u, LabeledProjection):
+            updates.append((getattr(t, u.row_key)._column, u._expr))
+        else:
+            f = getattr(t, u)
+            updates.append((f._column, Excluded(f)))
+
+    statement = Upsert(
+        t, columns, values,
+        [getattr(t, c)._column for c in conflict],
+        updates,
+        [getattr(t, r) for r in returning])
+    return statement.execute(using, session, batch_size)
+
+
+def excluded(field):
+    '''In an upsert update, the value that was to be inserted.'''
+    return Excluded(field)
+
+
+def summary(name, select, using='default'):
+    '''
+    A table named `name` holding the rows of a grouped select. Call
+    `.create()` to build it and `.connect()` to keep it current.
+
+    '''
+    return SummaryTable(name, select, using)
+
+
+def hash_join(left, right, on, using, kind="INNER", build=None):
+    '''
+    Join two selects living on different databases in Python. `on` is a
+    list of (left label, right label) pairs and `using` the pair of
+    database aliases. `kind` is "INNER" or "LEFT". `build` ("left" or
+    "right") is the side held in memory; if not given, both selects
+    are counted first to pick the smaller.
+
+    '''
+    return HashJoin(left, right, on, using, kind, build)
+
+
 def const(c):
     '''A constant SQL value. Escaped by the database engine.'''
     return Const(c)
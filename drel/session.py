@@ -0,0 +1,147 @@
+'''
+A `Session` groups several DRel statements into one unit of work on a
+single connection. Statements executed through a session share one
+cursor, optionally one transaction, and each statement is only
+compiled once per session. Temporary tables created with
+`Select.materialize` live as long as the session.
+
+'''
+import itertools
+
+from django.db import connections, transaction
+
+from drel.ast import InvalidQuery, NamedTable
+from drel.compiler import Compiler
+
+
+_temporary_names = itertools.count()
+
+
+def atomic(using):
+    '''A transaction context manager for the running Django version.'''
+    # `atomic` replaced `commit_on_success` in Django 1.6.
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic(using=using)
+    return transaction.commit_on_success(using=using)
+
+
+class Session(object):
+    def __init__(self, using='default', atomic=False):
+        self.using = using
+        self.connection = connections[using]
+        self._atomic = atomic
+        self._transaction = None
+        self._cursor = None
+        self._temporary = []
+        # Statements are immutable, so their compiled SQL can be
+        # reused. Keyed by id, holding on to the statement so the id
+        # can't be recycled while the session is open.
+        self._compiled = {}
+
+    def __enter__(self):
+        if self._atomic:
+            self._transaction = atomic(self.using)
+            self._transaction.__enter__()
+        self._cursor = self.connection.cursor()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._drop_temporary(exc_type is not None)
+            self._cursor.close()
+        finally:
+            self._cursor = None
+            self._compiled = {}
+            if self._transaction is not None:
+                self._transaction.__exit__(exc_type, exc_value, traceback)
+                self._transaction = None
+        return False
+
+    def compile(self, statement, cache=True):
+        '''
+        Return the SQL and values of a statement, keeping them for the
+        rest of the session if `cache` is set.
+
+        '''
+        try:
+            _, sql, values = self._compiled[id(statement)]
+        except KeyError:
+            compiler = Compiler(self.connection)
+            sql = statement._compile(compiler)
+            values = tuple(compiler.values)
+            if cache:
+                self._compiled[id(statement)] = (statement, sql, values)
+        return (sql, values)
+
+    def execute(self, statement, cache=True):
+        '''
+        Execute a statement on the session's cursor. Pass `cache=False`
+        for statements that won't be executed again.
+
+        '''
+        sql, values = self.compile(statement, cache)
+        return self._execute_sql(sql, values)
+
+    def materialize(self, select, indexes=()):
+        '''
+        Create a temporary table from a select, building `indexes` on
+        it, and return a table node for it.
+
+        '''
+        columns = [f.row_key for f in select._project]
+        indexes = [i if isinstance(i, (tuple, list)) else (i,)
+                   for i in indexes]
+        for index in indexes:
+            for column in index:
+                if column not in columns:
+                    raise InvalidQuery("%s is not projected" % column)
+
+        name = "drel_tmp_%d" % next(_temporary_names)
+        q = self.connection.ops.quote_name
+
+        index_names = [q("%s_%d" % (name, i)) for i in range(len(indexes))]
+        index_columns = [",".join(q(c) for c in index) for index in indexes]
+
+        sql, values = self.compile(select)
+        if self.connection.vendor == 'mysql':
+            # CREATE INDEX commits the transaction on MySQL, even for a
+            # temporary table, so the indexes are declared up front.
+            definitions = ",".join(
+                "INDEX %s (%s)" % i for i in zip(index_names, index_columns))
+            if definitions:
+                definitions = " (%s)" % definitions
+            self._execute_sql("CREATE TEMPORARY TABLE %s%s AS %s" % (
+                q(name), definitions, sql), values)
+            self._temporary.append(name)
+        else:
+            self._execute_sql(
+                "CREATE TEMPORARY TABLE %s AS %s" % (q(name), sql), values)
+            self._temporary.append(name)
+            for (index_name, columns) in zip(index_names, index_columns):
+                self._execute_sql("CREATE INDEX %s ON %s (%s)" % (
+                    index_name, q(name), columns))
+
+        return NamedTable(name, select._project)
+
+    def _execute_sql(self, sql, values=()):
+        if self._cursor is None:
+            raise InvalidQuery("Session is not open.")
+        self._cursor.execute(sql, values)
+        return self._cursor
+
+    def _drop_temporary(self, failed):
+        q = self.connection.ops.quote_name
+        # A plain DROP TABLE commits the transaction on MySQL.
+        drop = "DROP TABLE %s"
+        if self.connection.vendor == 'mysql':
+            drop = "DROP TEMPORARY TABLE %s"
+        while self._temporary:
+            name = self._temporary.pop()
+            try:
+                self._cursor.execute(drop % q(name))
+            except Exception:
+                # A failed transaction may refuse further statements
+                # (or have already rolled the table back); the table
+                # goes away with the connection regardless.
+                if not failed:
+                    raise
@@ -0,0 +1,183 @@
+'''
+Summary tables store the result of a grouped select so reads become a
+lookup by the group key instead of an aggregation.
+
+The table is created and backfilled with `CREATE TABLE ... AS`. Once
+connected, Django's save and delete signals on the models in the
+select keep it current: the groups a saved or deleted instance belongs
+to (before and after the change) are recomputed by running the select
+restricted to those groups. This works for any aggregate, including
+`min` and `max` after a delete, at the cost of one grouped query per
+affected group.
+
+'''
+from django.db import connections
+from django.db.models.signals import (
+    pre_save, post_save, pre_delete, post_delete)
+
+from drel.ast import (
+    Const, DjangoTable, Excluded, Field, InvalidQuery, NamedTable, Upsert)
+from drel.session import atomic
+
+
+class SummaryTable(object):
+    def __init__(self, name, select, using='default'):
+        if not select._group:
+            raise InvalidQuery("Summary tables need a grouped select.")
+
+        self.name = name
+        self.table = NamedTable(name, select._project)
+        self._select = select
+        self._using = using
+        self._group = list(select._group)
+        self._keys = [self._projected(f) for f in self._group]
+
+        tables = [select._source] + [j._table for j in select._joins]
+        self._sources = [t for t in tables if isinstance(t, DjangoTable)]
+
+    def _projected(self, field):
+        '''The label a group field is projected as.'''
+        if isinstance(field, Field):
+            for f in self._select._project:
+                if isinstance(f, Field) and f._table is field._table and \
+                        f._column == field._column:
+                    return f.row_key
+        raise InvalidQuery("%s must be a projected field" % field)
+
+    def create(self):
+        '''Create and backfill the table.'''
+        q = connections[self._using].ops.quote_name
+        sql, values = self._select._sql(self._using)
+        cursor = connections[self._using].cursor()
+        cursor.execute("CREATE TABLE %s AS %s" % (q(self.name), sql), values)
+        cursor.execute("CREATE UNIQUE INDEX %s ON %s (%s)" % (
+            q("%s_key" % self.name),
+            q(self.name),
+            ",".join(q(k) for k in self._keys)))
+        cursor.close()
+
+    def drop(self):
+        q = connections[self._using].ops.quote_name
+        cursor = connections[self._using].cursor()
+        cursor.execute("DROP TABLE %s" % q(self.name))
+        cursor.close()
+
+    def lookup(self, *key):
+        '''Return the row for a group key, or None.'''
+        t = self.table
+        fields = [getattr(t, k) for k in self._keys]
+        rows = list(t.where(self._match(fields, key))
+                    .project(*[getattr(t, c) for c in t._columns])
+                    .all(self._using))
+        return rows[0] if rows else None
+
+    def refresh(self, keys):
+        '''
+        Recompute the rows of the given group keys.
+
+        Each group is replaced in a transaction, after locking its row
+        where the backend supports SELECT ... FOR UPDATE, so a
+        concurrent refresh of the same group waits and then sees the
+        other's changes. Rows are written with an upsert, so two
+        refreshes creating the same new group don't collide on the
+        unique index. SQLite, which serializes writers, and NULL keys,
+        which a unique index doesn't match, fall back to replacing the
+        row.
+
+        '''
+        con = connections[self._using]
+        q = con.ops.quote_name
+        columns = self.table._columns
+        insert = "INSERT INTO %s (%s) VALUES (%s)" % (
+            q(self.name),
+            ",".join(q(c) for c in columns),
+            ",".join(["%s"] * len(columns)))
+        lock = getattr(con.features, 'has_select_for_update', False)
+        update = [(c, Excluded(getattr(self.table, c)))
+                  for c in columns if c not in self._keys]
+
+        for key in set(keys):
+            where = " AND ".join(
+                "%s IS NULL" % q(k) if v is None else "%s = %%s" % q(k)
+                for (k, v) in zip(self._keys, key))
+            key_values = [v for v in key if v is not None]
+
+            with atomic(self._using):
+                cursor = con.cursor()
+                if lock:
+                    cursor.execute("SELECT 1 FROM %s WHERE %s FOR UPDATE" % (
+                        q(self.name), where), key_values)
+
+                # Copy the raw rows: .all() would decode them.
+                select = self._select.where(self._match(self._group, key))
+                result = select._execute(self._using)
+                rows = result.fetchall()
+                result.close()
+
+                if rows and con.vendor != 'sqlite' and None not in key:
+                    Upsert(self.table, columns, [tuple(r) for r in rows],
+                           self._keys, update).execute(self._using)
+                else:
+                    cursor.execute(
+                        "DELETE FROM %s WHERE %s" % (q(self.name), where),
+                        key_values)
+                    for row in rows:
+                        cursor.execute(insert, row)
+                cursor.close()
+
+    def connect(self):
+        '''Keep the table current as the source models change.'''
+        for (signal, handler) in self._handlers():
+            for t in self._sources:
+                signal.connect(handler, sender=t._model, weak=False,
+                               dispatch_uid=self._uid(t))
+
+    def disconnect(self):
+        for (signal, handler) in self._handlers():
+            for t in self._sources:
+                signal.disconnect(sender=t._model,
+                                  dispatch_uid=self._uid(t))
+
+    def _uid(self, t):
+        return "drel.summary.%s.%s" % (self.name, t._model._meta.db_table)
+
+    def _handlers(self):
+        return [(pre_save, self._before),
+                (pre_delete, self._before),
+                (post_save, self._after),
+                (post_delete, self._after)]
+
+    def _before(self, sender, instance, **kwargs):
+        # Remember the groups the instance is in before it changes.
+        pending = instance.__dict__.setdefault('_drel_summary', {})
+        pending[self.name] = self._affected(sender, instance)
+
+    def _after(self, sender, instance, **kwargs):
+        keys = instance.__dict__.get('_drel_summary', {}).pop(self.name, [])
+        if kwargs.get('signal') is post_save:
+            keys = keys + self._affected(sender, instance)
+        self.refresh(keys)
+
+    def _affected(self, sender, instance):
+        '''The group keys the instance contributes to.'''
+        if instance.pk is None:
+            return []
+
+        keys = []
+        pk = sender._meta.pk.name
+        for t in self._sources:
+            if t._model is not sender:
+                continue
+            select = self._select._modified(
+                _project=self._group, _group=None, _order=None,
+                _limit=None, _offset=None)
+            select = select.where(getattr(t, pk) == Const(instance.pk))
+            keys.extend(tuple(row) for row in select.all(self._using))
+        return keys
+
+    def _match(self, fields, key):
+        cond = None
+        for (f, v) in zip(fields, key):
+            c = f.is_null if v is None else f == Const(v)
+            cond = c if cond is None else cond & c
+        return cond
@@ -5,5 +5,5 @@ setup(
     version='0.0.3',
     author='Kevin Mahoney',
     author_email='git@kevinmahoney.co.uk',
-    packages=['drel'],
+    packages=['drel', 'drel.management', 'drel.management.commands'],
     )
@@ -1,6 +1,16 @@
 from django.db import models
 
 
+class CommaSeparatedField(models.TextField):
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return value
+        return value.split(",")
+
+    def get_prep_value(self, value):
+        return ",".join(value)
+
+
 class TestModel1(models.Model):
     a = models.CharField(max_length=50)
     b = models.IntegerField()
@@ -25,3 +35,8 @@ class BlogPost(models.Model):
     body = models.TextField()
     published = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(BlogUser)
+
+
+class TaggedModel(models.Model):
+    tags = CommaSeparatedField()
+    n = models.IntegerField()
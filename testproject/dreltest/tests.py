@@ -1,17 +1,30 @@
-from django.test import TestCase
+import unittest
+
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase
 
 from dreltest.models import BlogUser, BlogPost
-from dreltest.models import TestModel1, TestModel2, TestM2M
+from dreltest.models import TestModel1, TestModel2, TestM2M, TaggedModel
 import drel as d
 
 
-class BlogTest(TestCase):
+def sqlite_before(version):
+    '''Is the test database an SQLite older than `version`?'''
+    if connection.vendor != 'sqlite':
+        return False
+    from django.db.backends.sqlite3.base import Database
+    return Database.sqlite_version_info < version
+
+
+class BlogFixture(object):
     def setUp(self):
         for i in range(10):
             u = BlogUser.objects.create(username="u%d" % i)
             for p in range(i):
                 BlogPost.objects.create(user=u, title="p%d" % p, body="Test")
 
+
+class BlogTest(BlogFixture, TestCase):
     def test_postcount(self):
         user = d.table(BlogUser)
         post = d.table(BlogPost)
@@ -62,7 +75,44 @@ class BlogTest(TestCase):
         self.assertEqual(latest, latest2)
 
 
-class DrelTest(TestCase):
+class BlogDDLTest(BlogFixture, TransactionTestCase):
+    # Creating tables and indexes commits the open transaction on
+    # some backends, which would leak fixtures out of a TestCase.
+    def test_summary(self):
+        user = d.table(BlogUser)
+        post = d.table(BlogPost)
+
+        counts = d.summary(
+            "dreltest_postcounts",
+            user
+            .leftjoin(post, post.user_id == user.id)
+            .group(user.username)
+            .project(user.username, d.count(post.id).label("posts")))
+        counts.create()
+        counts.connect()
+        try:
+            self.assertEqual(3, counts.lookup("u3").posts)
+
+            u = BlogUser.objects.get(username="u3")
+            p = BlogPost.objects.create(user=u, title="new", body="Test")
+            self.assertEqual(4, counts.lookup("u3").posts)
+
+            p.user = BlogUser.objects.get(username="u0")
+            p.save()
+            self.assertEqual(3, counts.lookup("u3").posts)
+            self.assertEqual(1, counts.lookup("u0").posts)
+
+            p.delete()
+            self.assertEqual(0, counts.lookup("u0").posts)
+
+            BlogUser.objects.create(username="new")
+            self.assertEqual(0, counts.lookup("new").posts)
+        finally:
+            counts.disconnect()
+            counts.drop()
+
+
+class DrelFixture(object):
     def setUp(self):
         x = TestModel1.objects.create(a="x", b=1)
         TestModel2.objects.create(m1=x, c=1)
@@ -79,6 +129,8 @@ class DrelTest(TestCase):
         m1.m2s.add(t1)
         m1.m2s.add(t2)
 
+
+class DrelTest(DrelFixture, TestCase):
     def test_simple(self):
         t2 = d.table(TestModel2)
 
@@ -197,3 +249,266 @@ class DrelTest(TestCase):
         test2 = list(t2.order(t2.c).limit(1).offset(1).project(t2.c).all())
         self.assertEqual(1, len(test2))
         self.assertEqual(2, test2[0].c)
+
+    def test_partition(self):
+        t2 = d.table(TestModel2)
+        q = t2.where((t2.c < d.const(3)) | (t2.c > d.const(4))).project(t2.c)
+
+        # Three ranges and the NULL partition.
+        parts = q.partition(t2.id, 3)
+        self.assertEqual(4, len(parts))
+
+        cs = [r.c for p in parts for r in p.all()]
+        self.assertEqual([1, 2, 5, 6], sorted(cs))
+        self.assertEqual(len(cs), len(set(cs)))
+
+        empty = t2.where(t2.c > d.const(6)).project(t2.c)
+        self.assertEqual(1, len(empty.partition(t2.id, 3)))
+
+        # Rows with a NULL key are still returned once.
+        t1 = d.table(TestModel1)
+        TestModel1.objects.create(a="z", b=3)
+        joined = t1.leftjoin(t2, t2.m1 == t1.id).project(t1.a)
+        r = [x.a for p in joined.partition(t2.id, 3) for x in p.all()]
+        self.assertEqual(["x"] * 3 + ["y"] * 3 + ["z"], sorted(r))
+
+        self.assertRaises(d.InvalidQuery, q.partition, t2.id, 0)
+
+        grouped = t2.group(t2.m1).project(t2.m1, d.count().label("n"))
+        self.assertRaises(d.InvalidQuery, grouped.partition, t2.id, 3)
+        counts = [r.n for p in grouped.partition(t2.m1, 3) for r in p.all()]
+        self.assertEqual([3, 3], counts)
+
+    @unittest.skipUnless(hasattr(connection.ops, 'get_db_converters'),
+                         "Django has no field converters")
+    def test_decode(self):
+        TaggedModel.objects.create(tags=["a", "b"], n=1)
+        t = d.table(TaggedModel)
+
+        self.assertEqual(["a", "b"], t.project(t.tags).one().tags)
+        self.assertEqual(["a", "b"],
+                         t.project(t.tags.label("x")).one().x)
+        self.assertEqual(1, t.project(t.n).one().n)
+
+        sub = t.project(t.tags, t.n).subquery
+        self.assertEqual(["a", "b"], sub.project(sub.tags).one().tags)
+
+        # Aggregates aren't model fields, so come back unconverted.
+        self.assertEqual("a,b", t.project(d.max(t.tags).label("m")).one().m)
+
+        # Unions only convert when every select converts alike.
+        own = t.project(t.tags)
+        self.assertEqual([["a", "b"], ["a", "b"]],
+                         [r.tags for r in own.union_all(own).all()])
+        t1 = d.table(TestModel1)
+        other = t1.where(t1.a == d.const("x")).project(t1.a.label("tags"))
+        self.assertEqual(["a,b", "x"],
+                         sorted(r.tags for r in own.union_all(other).all()))
+
+        # Nor do their columns read through a subquery.
+        sub = own.union_all(own).subquery
+        self.assertEqual([["a", "b"], ["a", "b"]],
+                         [r.tags for r in sub.project(sub.tags).all()])
+        sub = own.union_all(other).subquery
+        self.assertEqual(["a,b", "x"],
+                         sorted(r.tags for r in sub.project(sub.tags).all()))
+
+    def test_session(self):
+        t2 = d.table(TestModel2)
+        q = t2.where(t2.c > d.const(3)).project(t2.c)
+
+        with d.session(atomic=True) as s:
+            self.assertEqual(3, len(list(q.all(session=s))))
+            self.assertEqual(s.compile(q), s.compile(q))
+            total = t2.project(d.sum(t2.c).label("total")).one(session=s)
+            self.assertEqual(21, total.total)
+            self.assertEqual(3, len(list(q.all(session=s))))
+
+        self.assertRaises(d.InvalidQuery, q.one, session=s)
+
+    @unittest.skipIf(sqlite_before((3, 24)), "SQLite has no upsert")
+    def test_upsert(self):
+        t1 = d.table(TestModel1)
+        x = TestModel1.objects.get(a="x")
+
+        d.upsert(t1, [{"id": x.id, "a": "x", "b": 10},
+                      {"id": x.id + 100, "a": "z", "b": 3}],
+                 conflict=["id"], update=["b"])
+        self.assertEqual(10, TestModel1.objects.get(a="x").b)
+        self.assertEqual(3, TestModel1.objects.get(a="z").b)
+        self.assertEqual(3, TestModel1.objects.count())
+
+        d.upsert(t1, [{"id": x.id, "a": "x", "b": 5}],
+                 conflict=["id"],
+                 update=[(t1.b + d.excluded(t1.b)).label("b")])
+        self.assertEqual(15, TestModel1.objects.get(a="x").b)
+
+    @unittest.skipIf(sqlite_before((3, 35)), "SQLite has no RETURNING")
+    def test_upsert_batches(self):
+        t1 = d.table(TestModel1)
+        x = TestModel1.objects.get(a="x")
+
+        rows = [{"id": x.id + 100 + i, "a": "n%d" % i, "b": i}
+                for i in range(5)]
+        rows.append({"id": x.id, "a": "x", "b": 7})
+        rows.append({"id": x.id, "a": "x", "b": 8})
+
+        r = d.upsert(t1, rows, conflict=["id"], update=["b"],
+                     returning=["id"], batch_size=2)
+        self.assertEqual(sorted([x.id] + [x.id + 100 + i for i in range(5)]),
+                         sorted(row.id for row in r))
+        self.assertEqual(8, TestModel1.objects.get(a="x").b)
+        self.assertEqual(7, TestModel1.objects.count())
+
+    @unittest.skipIf(sqlite_before((3, 24)), "SQLite has no upsert")
+    def test_upsert_prep(self):
+        t = d.table(TaggedModel)
+
+        d.upsert(t, [{"id": 1, "tags": ["a", "b"], "n": 1}],
+                 conflict=["id"], update=["tags"])
+        d.upsert(t, [{"id": 1, "tags": ["a", "c"], "n": 1}],
+                 conflict=["id"], update=["tags"])
+        self.assertEqual(1, TaggedModel.objects.count())
+        self.assertTrue(TaggedModel.objects.filter(tags=["a", "c"]).exists())
+
+    def test_hash_join(self):
+        t1 = d.table(TestModel1)
+        t2 = d.table(TestModel2)
+
+        left = t1.project(t1.id, t1.a)
+        right = t2.where(t2.c > d.const(3)).project(t2.m1_id, t2.c)
+
+        r = list(d.hash_join(left, right, [("id", "m1_id")],
+                             ("default", "default")).all())
+        self.assertEqual([("y", 4), ("y", 5), ("y", 6)],
+                         sorted((x.a, x.c) for x in r))
+
+        r = list(d.hash_join(left, right, [("id", "m1_id")],
+                             ("default", "default"), "LEFT").all())
+        self.assertEqual([("x", None), ("y", 4), ("y", 5), ("y", 6)],
+                         sorted((x.a, x.c) for x in r))
+
+        # With the smaller side on the right.
+        r = list(d.hash_join(right, left, [("m1_id", "id")],
+                             ("default", "default"), "LEFT").all())
+        self.assertEqual([(4, "y"), (5, "y"), (6, "y")],
+                         sorted((x.c, x.a) for x in r))
+
+        r = list(d.hash_join(left, right, [("id", "m1_id")],
+                             ("default", "default"), "LEFT",
+                             build="right").all())
+        self.assertEqual([("x", None), ("y", 4), ("y", 5), ("y", 6)],
+                         sorted((x.a, x.c) for x in r))
+
+        self.assertRaises(d.InvalidQuery, d.hash_join, left, right,
+                          [("id", "nope")], ("default", "default"))
+
+    def test_union(self):
+        t1 = d.table(TestModel1)
+        t2 = d.table(TestModel2)
+
+        low = t2.where(t2.c < d.const(3)).project(t2.c)
+        high = t2.where(t2.c > d.const(4)).project(t2.c)
+
+        r = [x.c for x in low.union_all(high).order(t2.c.desc).all()]
+        self.assertEqual([6, 5, 2, 1], r)
+
+        r = [x.c for x in low.union_all(high).union_all(low)
+             .order(t2.c).limit(3).all()]
+        self.assertEqual([1, 1, 2], r)
+
+        r = [x.c for x in low.union(low).order(d.label("c")).all()]
+        self.assertEqual([1, 2], r)
+
+        r = list(low.intersect(t2.project(t2.c).order(t2.c).limit(1)).all())
+        self.assertEqual([1], [x.c for x in r])
+
+        r = list(low.except_(t2.where(t2.c < d.const(2)).project(t2.c)).all())
+        self.assertEqual([2], [x.c for x in r])
+
+        both = low.union_all(high).subquery
+        total = both.project(d.sum(both.c).label("total")).one()
+        self.assertEqual(1 + 2 + 5 + 6, total.total)
+
+        self.assertRaises(d.InvalidQuery, low.union, t1.project(t1.b))
+        self.assertRaises(d.InvalidQuery, list,
+                          low.union_all(high).order(t2.m1).all())
+        self.assertRaises(d.InvalidQuery, list,
+                          low.union_all(high).order(d.label("x")).all())
+
+
+class DrelDDLTest(DrelFixture, TransactionTestCase):
+    # See BlogDDLTest.
+    def test_materialize(self):
+        t1 = d.table(TestModel1)
+        t2 = d.table(TestModel2)
+
+        with d.session() as s:
+            totals = (t2
+                      .group(t2.m1)
+                      .project(t2.m1, d.sum(t2.c).label("total"))
+                      .materialize(s, indexes=["m1", ("m1", "total")]))
+
+            r = dict(t1
+                     .join(totals, totals.m1 == t1.id)
+                     .project(t1.a, totals.total)
+                     .all(session=s))
+            self.assertEqual({"x": 6, "y": 15}, r)
+
+            self.assertRaises(d.InvalidQuery,
+                              t2.project(t2.c).materialize, s, ["m1"])
+
+    def test_advise(self):
+        t1 = d.table(TestModel1)
+        t2 = d.table(TestModel2)
+
+        q = (t2
+             .join(t1, t1.id == t2.m1)
+             .where(t2.c > d.const(3))
+             .project(t1.a, t2.c))
+
+        table = TestModel2._meta.db_table
+        expected = [(table, ("c",), "where")]
+        if not hasattr(connection.introspection, 'get_constraints'):
+            # Older Django only reports primary key and unique columns,
+            # so the foreign key's index isn't seen.
+            expected.insert(0, (table, ("m1_id",), "join"))
+        self.assertEqual(expected, [tuple(s) for s in d.advise(q)])
+
+        self.assertEqual([], d.advise(t2.where(t2.id == d.const(1))
+                                      .project(t2.c)))
+
+
+class PartitionedTest(TransactionTestCase):
+    # Workers use their own connections, so the rows have to be
+    # committed for them to see.
+    def setUp(self):
+        x = TestModel1.objects.create(a="x", b=1)
+        for c in range(20):
+            TestModel2.objects.create(m1=x, c=c)
+
+    def test_partitioned(self):
+        t2 = d.table(TestModel2)
+        q = t2.where(t2.c > d.const(4)).project(t2.c)
+
+        r = [x.c for x in q.partitioned(t2.id, 4, workers=3)]
+        self.assertEqual(list(range(5, 20)), sorted(r))
+
+        r = [x.c for x in q.partitioned(t2.id, 4, workers=3, ordered=True)]
+        self.assertEqual(list(range(5, 20)), r)
+
+        # Small batches and buffers, so workers block on a slow consumer.
+        r = [x.c for x in q.partitioned(t2.id, 4, workers=3, ordered=True,
+                                        batch_size=2, buffer=1)]
+        self.assertEqual(list(range(5, 20)), r)
+
+        # Abandoning the scan early stops the workers.
+        r = q.partitioned(t2.id, 4, batch_size=1, buffer=1)
+        next(r)
+        r.close()
+
+    def test_partitioned_error(self):
+        t2 = d.table(TestModel2)
+        q = t2.project(d.raw_expr("no_such_column").label("x"))
+
+        self.assertRaises(DatabaseError, list, q.partitioned(t2.id, 4))
@@ -6,6 +6,10 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',
         'PORT': '',
+        # A file rather than an in-memory database, so connections
+        # opened by other threads see the test tables.
+        'TEST_NAME': 'test_drel.db',
+        'TEST': {'NAME': 'test_drel.db'},
     }
 }
 